@@ -1,14 +1,45 @@
 import streamlit as st
-import requests
+from streamlit.runtime.scriptrunner import add_script_run_ctx, get_script_run_ctx
+import orjson
 import re
-import json
 import os
 import sys
-import pandas as pd
-from supabase import create_client, Client
-from typing import Dict, List, Any, Union
+import time
+import hashlib
+import importlib.util
+import threading
+import itertools
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import sqlglot
+from sqlglot import exp
+from typing import TYPE_CHECKING, Dict, List, Any, Union
 from dotenv import load_dotenv
 
+# pandas, supabase and httpx are imported where they are first needed
+if TYPE_CHECKING:
+    import httpx
+    from supabase import Client
+
+# Patterns and keyword sets used when parsing prompts and generated SQL
+_ROWREF_RE = re.compile(r"(?:row|record|id)\s*(?:number)?\s*(\d+)")
+_WORD_RE = re.compile(r"[a-z_]+")
+_SQL_RE = re.compile(r"(SELECT|INSERT|UPDATE|DELETE).*", re.IGNORECASE | re.DOTALL)
+
+_UPDATE_KWS = frozenset({"update", "modify", "change", "set"})
+_DELETE_KWS = frozenset({"delete", "remove"})
+_INSERT_KWS = frozenset({"insert", "add", "create", "new"})
+_SELECT_KWS = frozenset({"fetch", "show", "get", "select", "find", "list"})
+_COMMON_TABLES = ("employees", "customers", "orders", "products", "refund_requests")
+
+# Oldest queries are dropped from the history beyond this many entries
+_HISTORY_LIMIT = 50
+
+# Arrow-backed DataFrames are used when pyarrow is installed
+_HAS_PYARROW = importlib.util.find_spec("pyarrow") is not None
+
+_FALLBACK_SCHEMA_DESCRIPTION = "Generate SQL using the common tables like 'employees', 'customers', 'orders', 'products', or 'refund_requests' with standard columns."
+
 st.set_page_config(
     page_title="NL to SQL Database Assistant",
     page_icon="🤖",
@@ -27,13 +58,29 @@ except Exception as e:
 
 # Initialize session state variables
 if 'query_history' not in st.session_state:
-    st.session_state.query_history = []
-if 'schema_data' not in st.session_state:
-    st.session_state.schema_data = None
+    st.session_state.query_history = deque(maxlen=_HISTORY_LIMIT)
+if 'query_count' not in st.session_state:
+    st.session_state.query_count = 0
 if 'connected' not in st.session_state:
     st.session_state.connected = False
 if 'connection_error' not in st.session_state:
     st.session_state.connection_error = None
+if 'connection' not in st.session_state:
+    st.session_state.connection = None
+if 'rpc_name' not in st.session_state:
+    st.session_state.rpc_name = None
+if 'schema_rpc' not in st.session_state:
+    st.session_state.schema_rpc = False
+if 'schema_seed' not in st.session_state:
+    st.session_state.schema_seed = None
+if 'arrow_rpc' not in st.session_state:
+    st.session_state.arrow_rpc = False
+if 'schema_prompt' not in st.session_state:
+    st.session_state.schema_prompt = None
+if 'schema_key' not in st.session_state:
+    st.session_state.schema_key = None
+if 'latest_results' not in st.session_state:
+    st.session_state.latest_results = None
 
 # Set up sidebar
 st.sidebar.title("Database Connection")
@@ -42,20 +89,116 @@ st.sidebar.title("Database Connection")
 supabase_url = st.sidebar.text_input("Supabase URL", os.environ.get('SUPABASE_URL', ''))
 supabase_key = st.sidebar.text_input("Supabase Key", os.environ.get('SUPABASE_KEY', ''), type="password")
 gemini_api_key = st.sidebar.text_input("Gemini API Key", os.environ.get('GEMINI_API_KEY', ''), type="password")
+st.sidebar.slider("Rows per page", min_value=50, max_value=5000, value=500, step=50, key="page_size",
+                  help="SELECT queries without a LIMIT fetch this many rows at a time")
+st.sidebar.slider("Show last N queries", min_value=5, max_value=_HISTORY_LIMIT, value=10, key="history_size")
+
+@st.cache_resource(show_spinner=False)
+def get_client(url: str, key: str) -> "Client":
+    from supabase import create_client
+    
+    # Shared across sessions so the underlying connection pool is reused
+    return create_client(url, key)
+
+def _connected_client() -> "Client":
+    # Uses the URL and key saved on Connect, so later sidebar edits need another Connect
+    return get_client(*st.session_state.connection)
+
+@st.cache_resource(show_spinner=False)
+def _http_client() -> "httpx.Client":
+    import httpx
+    
+    # Keep-alive HTTP/2 client so repeated Gemini and Arrow calls skip the TCP/TLS handshake
+    transport = httpx.HTTPTransport(
+        http2=True,
+        retries=2,
+        limits=httpx.Limits(max_connections=16, max_keepalive_connections=4),
+    )
+    return httpx.Client(timeout=30.0, transport=transport)
+
+@st.cache_resource(show_spinner=False)
+def _gemini_slots() -> threading.Semaphore:
+    # Caps how many Gemini requests are in flight at once across all sessions.
+    # This limits concurrency only, not requests per minute.
+    return threading.Semaphore(8)
+
+@st.cache_resource(show_spinner=False)
+def _pool() -> ThreadPoolExecutor:
+    return ThreadPoolExecutor(max_workers=16)
+
+def gemini_api_url() -> str:
+    return f'https://generativelanguage.googleapis.com/v1beta/models/gemini-2.0-flash:streamGenerateContent?alt=sse&key={gemini_api_key}'
+
+def _probe_sql_rpc(sb):
+    # Finds which SQL function this database exposes so queries never need a fallback call
+    test_query = "SELECT 1 as test"
+    error = None
+    for rpc_name in ("run_sql_query", "run_sql"):
+        try:
+            if sb.rpc(rpc_name, {'sql_query': test_query}).execute().data:
+                return rpc_name
+        except Exception as e:
+            error = e
+    if error:
+        raise error
+    return None
+
+def _probe_schema_rpc(sb):
+    # Returns the get_table_schema rows so they can serve as the first schema load
+    try:
+        return sb.rpc("get_table_schema", {}).execute().data or None
+    except Exception as e:
+        print(f"Direct RPC call failed: {str(e)}, falling back to SQL query.")
+        return None
+
+def _fetch_arrow(sql_query: str):
+    # Calls an optional run_sql_arrow(sql_query text) function that returns the result set
+    # as an Arrow IPC stream in a bytea, which PostgREST serves raw for application/octet-stream
+    import pandas as pd
+    import pyarrow as pa
+    
+    url, key = st.session_state.connection
+    response = _http_client().post(
+        f"{url.rstrip('/')}/rest/v1/rpc/run_sql_arrow",
+        content=orjson.dumps({"sql_query": sql_query}),
+        headers={
+            "apikey": key,
+            "Authorization": f"Bearer {key}",
+            "Content-Type": "application/json",
+            "Accept": "application/octet-stream",
+        },
+    )
+    response.raise_for_status()
+    table = pa.ipc.open_stream(response.content).read_all()
+    return table.to_pandas(types_mapper=pd.ArrowDtype)
+
+def _probe_arrow_rpc() -> bool:
+    if not _HAS_PYARROW:
+        return False
+    try:
+        _fetch_arrow("SELECT 1 as test")
+        return True
+    except Exception as e:
+        print(f"Arrow RPC call failed: {str(e)}, using JSON results.")
+        return False
 
 # Connect button
 if st.sidebar.button("Connect to Database"):
     try:
         with st.spinner("Connecting to Supabase..."):
-            sb = create_client(supabase_url, supabase_key)
-            test_query = "SELECT 1 as test"
-            test_response = sb.rpc('run_sql', {'sql_query': test_query}).execute()
+            sb = get_client(supabase_url, supabase_key)
+            rpc_name = _probe_sql_rpc(sb)
             
-            if test_response.data:
+            if rpc_name:
                 st.session_state.connected = True
                 st.session_state.connection_error = None
-                st.session_state.sb = sb
-                st.session_state.GEMINI_API_URL = f'https://generativelanguage.googleapis.com/v1beta/models/gemini-2.0-flash:generateContent?key={gemini_api_key}'
+                st.session_state.rpc_name = rpc_name
+                st.session_state.connection = (supabase_url, supabase_key)
+                st.session_state.schema_seed = _probe_schema_rpc(sb)
+                st.session_state.schema_rpc = st.session_state.schema_seed is not None
+                st.session_state.arrow_rpc = _probe_arrow_rpc()
+                st.session_state.schema_prompt = None
+                st.session_state.schema_key = None
                 st.sidebar.success("Successfully connected to Supabase!")
             else:
                 st.session_state.connection_error = "Connected but received empty response from test query"
@@ -78,94 +221,182 @@ Ask questions about your database in natural language and get SQL queries and re
 """)
 
 # Define functions
-def get_supabase_schema():
-    if not st.session_state.connected:
-        return {"error": "Not connected to database"}
-        
-    try:
+def _build_schema(rows):
+    schema = {}
+    for entry in rows:
+        table = entry["table_name"]
+        column = entry["column_name"]
+        if table not in schema:
+            schema[table] = []
+        schema[table].append(column)
+    return schema
+
+@st.cache_data(ttl=300, show_spinner=False)
+def _fetch_schema(url: str, key_hash: str, rpc_name: str, schema_rpc: bool, _sb, _seed=None) -> Dict[str, List[str]]:
+    # Errors are raised rather than returned so that they are never cached.
+    # _seed holds the rows already fetched by the connect probe.
+    if _seed:
+        return _build_schema(_seed)
+    
+    if schema_rpc:
         try:
-            response = st.session_state.sb.rpc("get_table_schema", {}).execute()
+            response = _sb.rpc("get_table_schema", {}).execute()
             
             if response.data:
-                schema = {}
-                for entry in response.data:
-                    table = entry["table_name"]
-                    column = entry["column_name"]
-                    if table not in schema:
-                        schema[table] = []
-                    schema[table].append(column)
-                return schema
+                return _build_schema(response.data)
         except Exception as func_error:
             print(f"Direct RPC call failed: {str(func_error)}, falling back to SQL query.")
-            
-        schema_query = """
-        SELECT table_name, column_name
-        FROM information_schema.columns
-        WHERE table_schema = 'public'
-        ORDER BY table_name, ordinal_position
-        """
-        response = st.session_state.sb.rpc('run_sql_query', {'sql_query': schema_query}).execute()
         
-        if not response.data:
-            response = st.session_state.sb.rpc('run_sql', {'sql_query': schema_query}).execute()
+    schema_query = """
+    SELECT table_name, column_name
+    FROM information_schema.columns
+    WHERE table_schema = 'public'
+    ORDER BY table_name, ordinal_position
+    """
+    response = _sb.rpc(rpc_name, {'sql_query': schema_query}).execute()
+    
+    if response.data:
+        return _build_schema(response.data)
+    raise RuntimeError("No data returned from schema query")
+
+def get_supabase_schema():
+    if not st.session_state.connected:
+        return {"error": "Not connected to database"}
         
-        if response.data:
-            schema = {}
-            for entry in response.data:
-                table = entry["table_name"]
-                column = entry["column_name"]
-                if table not in schema:
-                    schema[table] = []
-                schema[table].append(column)
-            return schema
-        else:
-            return {"error": "No data returned from schema query"}
+    try:
+        url, key = st.session_state.connection
+        key_hash = hashlib.sha256(key.encode()).hexdigest()
+        seed, st.session_state.schema_seed = st.session_state.schema_seed, None
+        return _fetch_schema(url, key_hash, st.session_state.rpc_name, st.session_state.schema_rpc,
+                             _connected_client(), _seed=seed)
+    except RuntimeError as e:
+        return {"error": str(e)}
     except Exception as e:
         return {"error": f"Exception occurred while fetching schema: {str(e)}"}
 
-def format_schema_for_prompt(schema_data):
-    schema_str = "Here is the database schema:\n"
-    
-    if isinstance(schema_data, dict) and "error" not in schema_data:
-        for table, columns in schema_data.items():
-            schema_str += f"\nTable `{table}` with columns: {', '.join(columns)}"
-    elif isinstance(schema_data, list):
-        table_dict = {}
-        for row in schema_data:
-            table = row['table_name']
-            column = row['column_name']
-            if table not in table_dict:
-                table_dict[table] = []
-            table_dict[table].append(column)
-            
-        for table, columns in table_dict.items():
-            schema_str += f"\nTable `{table}` with columns: {', '.join(columns)}"
+def format_schema_lines(schema_data: Dict[str, List[str]]) -> Dict[str, str]:
+    return {table: f"Table `{table}` with columns: {', '.join(columns)}" for table, columns in schema_data.items()}
+
+@st.cache_data(show_spinner=False)
+def _schema_lines(schema_key: str, _schema_data: Dict[str, List[str]]) -> Dict[str, str]:
+    # Keyed on the schema hash so sessions share one copy rather than each keeping its own
+    return format_schema_lines(_schema_data)
+
+def format_schema_for_prompt(schema_lines: Dict[str, str]) -> str:
+    return "Here is the database schema:\n" + "".join(f"\n{line}" for line in schema_lines.values())
+
+def _schema_description():
+    # Pre-rendered once per schema load, see the schema fetch below
+    schema_prompt = st.session_state.get('schema_prompt')
+    return schema_prompt or _FALLBACK_SCHEMA_DESCRIPTION, not schema_prompt
+
+def _mentions_table(table: str, prompt_lower: str, words) -> bool:
+    name = table.lower()
+    variants = {name, name[:-1] if name.endswith('s') else name + 's'}
+    return bool(variants & words) or ('_' in name and name.replace('_', ' ') in prompt_lower)
+
+def _schema_digest(prompt_lower: str, words):
+    # Full column lists only for the tables the question mentions, the rest by name only.
+    # Returns the description and the lowercased names of tables whose columns were left out.
+    schema_description, schema_error = _schema_description()
+    if schema_error:
+        return schema_description, frozenset()
+    schema_data = get_supabase_schema()
+    if "error" in schema_data:
+        return schema_description, frozenset()
     
-    return schema_str
+    schema_lines = _schema_lines(st.session_state.schema_key, schema_data)
 
-def nl_to_sql_gemini(prompt: str):
-    if not st.session_state.connected:
-        return {"error": "Not connected to database"}
-        
+    mentioned = {table for table in schema_lines if _mentions_table(table, prompt_lower, words)}
+    if not mentioned or len(mentioned) == len(schema_lines):
+        return schema_description, frozenset()
+
+    omitted = [table for table in schema_lines if table not in mentioned]
+    digest = (
+        "Here is the database schema:\n"
+        + "".join(f"\n{line}" for table, line in schema_lines.items() if table in mentioned)
+        + f"\n\nOther tables (columns omitted): {', '.join(omitted)}"
+    )
+    return digest, frozenset(table.lower() for table in omitted)
+
+def _call_gemini(refined_prompt: str, stop=None):
     headers = {
         "Content-Type": "application/json"
     }
 
-    schema_data = st.session_state.schema_data
-    schema_error = schema_data is None or (isinstance(schema_data, dict) and "error" in schema_data)
+    payload = {
+        "contents": [
+            {
+                "parts": [
+                    {"text": refined_prompt}
+                ]
+            }
+        ]
+    }
+
+    body = orjson.dumps(payload)
+    retries = 2
+
+    try:
+        with _gemini_slots():
+            for attempt in range(retries + 1):
+                with _http_client().stream("POST", gemini_api_url(), content=body, headers=headers) as response:
+                    if response.status_code in (429, 500, 502, 503, 504) and attempt < retries:
+                        time.sleep(0.2 * 2 ** attempt)
+                        continue
+                    if response.status_code != 200:
+                        response.read()
+                        return {"error": f"Gemini API error: {response.text}"}
+
+                    # Server-sent events, one JSON chunk per "data:" line
+                    text = ""
+                    received = False
+                    for line in response.iter_lines():
+                        if not line.startswith("data: "):
+                            continue
+                        candidates = orjson.loads(line[len("data: "):]).get('candidates', [])
+                        if not candidates:
+                            continue
+                        received = True
+                        text += candidates[0].get('content', {}).get('parts', [{}])[0].get('text', '')
+                        if candidates[0].get('finishReason') or (stop and stop(text)):
+                            break
+                    break
+
+        if not received:
+            return {"error": "No candidates returned by Gemini."}
+        return text
+    except Exception as e:
+        return {"error": f"Error calling Gemini API: {str(e)}"}
+
+def _extract_sql(text: str) -> str:
+    text = text.replace('```sql', '').replace('```', '').strip()
     
-    if schema_error:
-        schema_description = "Generate SQL using the common tables like 'employees', 'customers', 'orders', 'products', or 'refund_requests' with standard columns."
-    else:
-        schema_description = format_schema_for_prompt(schema_data)
+    sql_match = _SQL_RE.search(text)
+    if sql_match:
+        return sql_match.group(0).strip()
+    return text.strip()
+
+def _sql_complete(text: str) -> bool:
+    # A statement is complete once it ends in a semicolon outside a string literal
+    sql_match = _SQL_RE.search(text)
+    return bool(sql_match) and sql_match.group(0).rstrip().endswith(";") and sql_match.group(0).count("'") % 2 == 0
+
+def nl_to_sql_gemini(prompt: str):
+    if not st.session_state.connected:
+        return {"error": "Not connected to database"}
 
+    # Tokenize once; keyword and table checks are then set lookups
     prompt_lower = prompt.lower()
-    is_update = "update" in prompt_lower or "modify" in prompt_lower or "change" in prompt_lower or "set" in prompt_lower
-    is_delete = "delete" in prompt_lower or "remove" in prompt_lower
-    is_insert = "insert" in prompt_lower or "add" in prompt_lower or "create" in prompt_lower or "new" in prompt_lower
-    is_select = "fetch" in prompt_lower or "show" in prompt_lower or "get" in prompt_lower or "select" in prompt_lower or "find" in prompt_lower or "list" in prompt_lower
+    words = set(_WORD_RE.findall(prompt_lower))
+    schema_description, omitted_tables = _schema_digest(prompt_lower, words)
+    schema_error = not st.session_state.get('schema_prompt')
+    is_update = bool(words & _UPDATE_KWS)
+    is_delete = bool(words & _DELETE_KWS)
+    is_insert = bool(words & _INSERT_KWS)
+    is_select = bool(words & _SELECT_KWS)
 
-    has_row_reference = re.search(r"(?:row|record|id)\s*(?:number)?\s*(\d+)", prompt_lower)
+    has_row_reference = _ROWREF_RE.search(prompt_lower)
     row_id = has_row_reference.group(1) if has_row_reference else None
 
     operation_guidance = ""
@@ -183,173 +414,215 @@ def nl_to_sql_gemini(prompt: str):
             operation_guidance += f"\n- Use 'WHERE id = {row_id}' as the condition"
 
     table_hint = ""
-    common_tables = ["employees", "customers", "orders", "products", "refund_requests"]
-    for table in common_tables:
-        if table in prompt_lower or table[:-1] in prompt_lower:
-            if schema_error:
-                table_hint = f"\nYou should use the '{table}' table for this query."
-            break
+    if schema_error:
+        hint_table = next((table for table in _COMMON_TABLES if table in words or table[:-1] in words), None)
+        if hint_table:
+            table_hint = f"\nYou should use the '{hint_table}' table for this query."
 
-    refined_prompt = (
-        f"{schema_description}\n\n"
+    request = (
         f"Generate a PostgreSQL query for: {prompt}.{operation_guidance}{table_hint}\n\n"
         f"Return only the SQL query without any explanation, markdown formatting, or backticks."
     )
+    refined_prompt = f"{schema_description}\n\n{request}"
+    full_prompt = f"{st.session_state.get('schema_prompt')}\n\n{request}" if omitted_tables else None
 
-    payload = {
-        "contents": [
-            {
-                "parts": [
-                    {"text": refined_prompt}
-                ]
-            }
-        ]
-    }
+    try:
+        return _nl_to_sql_cached(prompt, st.session_state.get('schema_key') or "", gemini_api_url(),
+                                 refined_prompt, full_prompt, omitted_tables)
+    except RuntimeError as e:
+        return {"error": str(e)}
+
+def _referenced_tables(sql: str):
+    try:
+        return {table.name.lower() for table in sqlglot.parse_one(sql, read='postgres').find_all(exp.Table)}
+    except sqlglot.errors.SqlglotError:
+        return set()
+
+def _generate_sql(refined_prompt: str) -> str:
+    text = _call_gemini(refined_prompt, stop=_sql_complete)
+    if isinstance(text, dict):
+        raise RuntimeError(text["error"])
+    sql = _extract_sql(text)
+    if not sql:
+        # e.g. a response blocked for safety; raised so the empty result is not cached
+        raise RuntimeError("Gemini returned no SQL for this request")
+    return sql
+
+@st.cache_data(ttl=3600, max_entries=512, show_spinner=False)
+def _nl_to_sql_cached(prompt: str, schema_key: str, api_url: str, _refined_prompt: str,
+                      _full_prompt: str = None, _omitted_tables=frozenset()) -> str:
+    # The prompts are derived from the other arguments, so they are left out of the cache key.
+    # Errors are raised rather than returned so that they are never cached.
+    sql = _generate_sql(_refined_prompt)
+    
+    # Ask again with the full schema if the SQL uses a table whose columns were left out
+    if _full_prompt and _referenced_tables(sql) & _omitted_tables:
+        sql = _generate_sql(_full_prompt)
+    return sql
+
+def nl_to_sql_gemini_batch(prompts: List[str]) -> List[Union[str, Dict[str, str]]]:
+    if not st.session_state.connected:
+        return [{"error": "Not connected to database"} for _ in prompts]
+    if len(prompts) == 1:
+        return [nl_to_sql_gemini(prompts[0])]
+
+    schema_description, _ = _schema_description()
+    numbered = "\n".join(f"{i}. {prompt}" for i, prompt in enumerate(prompts, start=1))
+
+    refined_prompt = (
+        f"{schema_description}\n\n"
+        f"For each of the following {len(prompts)} requests, return a JSON array of SQL strings in order:\n"
+        f"{numbered}\n\n"
+        f"Each SQL string must be a single PostgreSQL query. Use single quotes for strings and ILIKE for case-insensitive matching. "
+        f"Do NOT include auto-generated id or created_at columns in INSERT queries.\n"
+        f"Return only the JSON array without any explanation, markdown formatting, or backticks."
+    )
+
+    text = _call_gemini(refined_prompt)
+    if isinstance(text, dict):
+        return [text for _ in prompts]
+
+    try:
+        sql_list = orjson.loads(text.replace('```json', '').replace('```', '').strip())
+    except ValueError:
+        sql_list = None
+    if not isinstance(sql_list, list) or len(sql_list) != len(prompts):
+        print("Could not parse batched Gemini response, falling back to one request per question.")
+        return [nl_to_sql_gemini(prompt) for prompt in prompts]
+
+    return [
+        _extract_sql(sql) if isinstance(sql, str) and sql.strip() else nl_to_sql_gemini(prompt)
+        for prompt, sql in zip(prompts, sql_list)
+    ]
+
+def _literal_value(node):
+    if isinstance(node, exp.Null):
+        return None
+    if isinstance(node, exp.Boolean):
+        return node.this
+    if isinstance(node, exp.Neg) and isinstance(node.this, exp.Literal) and node.this.is_number:
+        return -_literal_value(node.this)
+    if isinstance(node, exp.Literal):
+        if node.is_string:
+            return node.this
+        try:
+            return int(node.this)
+        except ValueError:
+            return float(node.this)
+    raise ValueError(f"Not a literal value: {node.sql(dialect='postgres')}")
+
+def _where_filters(where):
+    # Only "column = literal" conditions joined by AND map onto .eq() filters
+    condition = where.this
+    conditions = list(condition.flatten()) if isinstance(condition, exp.And) else [condition]
+    filters = []
+    for item in conditions:
+        if not isinstance(item, exp.EQ) or not isinstance(item.this, exp.Column):
+            raise ValueError(f"Unsupported WHERE condition: {item.sql(dialect='postgres')}")
+        filters.append((item.this.name, _literal_value(item.expression)))
+    return filters
 
+def _run_table_operation(sb, query: str):
+    # Returns None when the statement should be run through the SQL RPC instead
     try:
-        response = requests.post(st.session_state.GEMINI_API_URL, json=payload, headers=headers)
-
-        if response.status_code == 200:
-            data = response.json()
-            candidates = data.get('candidates', [])
-            if candidates:
-                text = candidates[0].get('content', {}).get('parts', [{}])[0].get('text', '')
-                text = text.replace('```sql', '').replace('```', '').strip()
+        statements = sqlglot.parse(query, read='postgres')
+    except sqlglot.errors.SqlglotError:
+        return None
+    statements = [statement for statement in statements if statement is not None]
+    if len(statements) > 1:
+        # Each statement would otherwise reach the SQL RPC unchecked, including a DELETE without WHERE
+        return {"error": "Multiple SQL statements are not allowed. Please run one query at a time."}
+    if not statements:
+        return None
+    tree = statements[0]
+    
+    try:
+        if isinstance(tree, exp.Insert):
+            schema = tree.this
+            values = tree.expression
+            if not isinstance(schema, exp.Schema) or not isinstance(values, exp.Values) or tree.args.get('conflict') or tree.args.get('returning'):
+                return None
+            columns = [column.name for column in schema.expressions]
+            rows = []
+            for row in values.expressions:
+                if len(row.expressions) != len(columns):
+                    return None
+                rows.append({column: _literal_value(value) for column, value in zip(columns, row.expressions)})
+            
+            response = sb.table(schema.this.name).insert(rows[0] if len(rows) == 1 else rows).execute()
+            
+            if hasattr(response, 'error') and response.error:
+                return {"error": f"Insert failed: {response.error}"}
                 
-                sql_match = re.search(r'(SELECT|INSERT|UPDATE|DELETE).*', text, re.IGNORECASE | re.DOTALL)
-                if sql_match:
-                    return sql_match.group(0).strip()
-                return text.strip()
+            if hasattr(response, 'data'):
+                return response.data
             else:
-                return {"error": "No candidates returned by Gemini."}
-        else:
-            return {"error": f"Gemini API error: {response.text}"}
-    except Exception as e:
-        return {"error": f"Error calling Gemini API: {str(e)}"}
+                return {"message": "Insert was executed successfully", "success": True}
+        
+        elif isinstance(tree, exp.Update):
+            where = tree.args.get('where')
+            if where is None or tree.args.get('from') or tree.args.get('returning'):
+                return None
+            data = {}
+            for item in tree.expressions:
+                if not isinstance(item, exp.EQ) or not isinstance(item.this, exp.Column):
+                    return None
+                data[item.this.name] = _literal_value(item.expression)
+            
+            filters = _where_filters(where)
+            request = sb.table(tree.this.name).update(data)
+            for where_column, where_value in filters:
+                request = request.eq(where_column, where_value)
+            response = request.execute()
+            
+            if hasattr(response, 'error') and response.error:
+                return {"error": f"Update failed: {response.error}"}
+                
+            if hasattr(response, 'data'):
+                return response.data
+            else:
+                return {"message": "Update was executed successfully", "success": True}
+        
+        elif isinstance(tree, exp.Delete):
+            where = tree.args.get('where')
+            if where is None:
+                return {"error": "DELETE without WHERE clause is not allowed for safety. Please specify a WHERE condition."}
+            if tree.args.get('using') or tree.args.get('returning'):
+                return None
+            
+            filters = _where_filters(where)
+            request = sb.table(tree.this.name).delete()
+            for where_column, where_value in filters:
+                request = request.eq(where_column, where_value)
+            response = request.execute()
+            
+            if hasattr(response, 'error') and response.error:
+                return {"error": f"Delete failed: {response.error}"}
+                
+            if hasattr(response, 'data'):
+                return {"message": "Delete was executed successfully", "success": True, "rows_affected": len(response.data) if response.data else 0}
+            else:
+                return {"message": "Delete was executed successfully", "success": True}
+    except ValueError:
+        return None
+    
+    return None
 
-def execute_sql_query(query: str):
+def execute_sql_query(query: str, table_api: bool = True):
     if not st.session_state.connected:
         return {"error": "Not connected to database"}
         
     try:
+        sb = _connected_client()
         query = query.strip().rstrip(';')
         
-        if query.lower().startswith("insert into"):
-            match = re.match(r"insert\s+into\s+(\w+)\s*\((.*?)\)\s*values\s*\((.*?)\)", query, re.IGNORECASE)
-            if match:
-                table_name = match.group(1)
-                columns = [col.strip() for col in match.group(2).split(',')]
-                values = [val.strip() for val in match.group(3).split(',')]
-                
-                data = {}
-                for i, column in enumerate(columns):
-                    value = values[i]
-                    if value.upper() == 'NULL':
-                        data[column] = None
-                    elif (value.startswith("'") and value.endswith("'")) or (value.startswith('"') and value.endswith('"')):
-                        data[column] = value[1:-1]
-                    else:
-                        try:
-                            if '.' in value:
-                                data[column] = float(value)
-                            else:
-                                data[column] = int(value)
-                        except ValueError:
-                            data[column] = value
-                
-                response = st.session_state.sb.table(table_name).insert(data).execute()
-                
-                if hasattr(response, 'error') and response.error:
-                    return {"error": f"Insert failed: {response.error}"}
-                    
-                if hasattr(response, 'data'):
-                    return response.data
-                else:
-                    return {"message": "Insert was executed successfully", "success": True}
+        # Simple INSERT/UPDATE/DELETE statements go through the table API
+        if table_api:
+            table_result = _run_table_operation(sb, query)
+            if table_result is not None:
+                return table_result
         
-        elif query.lower().startswith("update"):
-            match = re.match(r"update\s+(\w+)\s+set\s+(.*?)\s+where\s+(.*)", query, re.IGNORECASE)
-            if match:
-                table_name = match.group(1)
-                set_clause = match.group(2)
-                where_clause = match.group(3)
-                
-                set_items = set_clause.split(',')
-                data = {}
-                
-                for item in set_items:
-                    if '=' in item:
-                        column, value = [part.strip() for part in item.split('=', 1)]
-                        
-                        if value.upper() == 'NULL':
-                            data[column] = None
-                        elif (value.startswith("'") and value.endswith("'")) or (value.startswith('"') and value.endswith('"')):
-                            data[column] = value[1:-1]
-                        else:
-                            try:
-                                if '.' in value:
-                                    data[column] = float(value)
-                                else:
-                                    data[column] = int(value)
-                            except ValueError:
-                                data[column] = value
-                
-                where_match = re.match(r"(\w+)\s*=\s*(\S+)", where_clause)
-                if where_match:
-                    where_column = where_match.group(1)
-                    where_value = where_match.group(2).strip()
-                    
-                    if where_value.startswith("'") and where_value.endswith("'"):
-                        where_value = where_value[1:-1]
-                    elif where_value.isdigit():
-                        where_value = int(where_value)
-                    
-                    response = st.session_state.sb.table(table_name).update(data).eq(where_column, where_value).execute()
-                    
-                    if hasattr(response, 'error') and response.error:
-                        return {"error": f"Update failed: {response.error}"}
-                        
-                    if hasattr(response, 'data'):
-                        return response.data
-                    else:
-                        return {"message": "Update was executed successfully", "success": True}
-                        
-        elif query.lower().startswith("delete from"):
-            match = re.match(r"delete\s+from\s+(\w+)(?:\s+where\s+(.*))?", query, re.IGNORECASE)
-            if match:
-                table_name = match.group(1)
-                where_clause = match.group(2) if match.group(2) else None
-                
-                if not where_clause:
-                    return {"error": "DELETE without WHERE clause is not allowed for safety. Please specify a WHERE condition."}
-                
-                where_match = re.match(r"(\w+)\s*=\s*(\S+)", where_clause)
-                if where_match:
-                    where_column = where_match.group(1)
-                    where_value = where_match.group(2).strip()
-                    
-                    if where_value.startswith("'") and where_value.endswith("'"):
-                        where_value = where_value[1:-1]
-                    elif where_value.isdigit():
-                        where_value = int(where_value)
-                    
-                    response = st.session_state.sb.table(table_name).delete().eq(where_column, where_value).execute()
-                    
-                    if hasattr(response, 'error') and response.error:
-                        return {"error": f"Delete failed: {response.error}"}
-                        
-                    if hasattr(response, 'data'):
-                        return {"message": "Delete was executed successfully", "success": True, "rows_affected": len(response.data) if response.data else 0}
-                    else:
-                        return {"message": "Delete was executed successfully", "success": True}
-        
-        try:
-            response = st.session_state.sb.rpc("run_sql_query", {"sql_query": query}).execute()
-        except Exception as e:
-            try:
-                response = st.session_state.sb.rpc('run_sql', {'sql_query': query}).execute()
-            except Exception as e2:
-                return {"error": f"Query failed: {str(e2)}"}
+        response = sb.rpc(st.session_state.rpc_name, {"sql_query": query}).execute()
             
         if hasattr(response, 'error') and response.error:
             return {"error": f"Database error: {response.error}"}
@@ -369,51 +642,184 @@ def execute_sql_query(query: str):
         error_message = str(e)
         return {"error": f"Query failed: {error_message}"}
 
+def _parse_select(sql_query: str):
+    # Returns the parsed statement if the query is a single SELECT, otherwise None
+    try:
+        statements = sqlglot.parse(sql_query.strip().rstrip(';'), read='postgres')
+    except sqlglot.errors.SqlglotError:
+        return None
+    if len(statements) != 1 or not isinstance(statements[0], exp.Select):
+        return None
+    return statements[0]
+
+def _paginate(tree, limit: int, offset: int = 0):
+    # Takes the result of _parse_select; returns None unless it is a SELECT without its own LIMIT/OFFSET
+    if tree is None or tree.args.get('limit') is not None or tree.args.get('offset') is not None:
+        return None
+    
+    tree = tree.limit(limit)
+    if offset:
+        tree = tree.offset(offset)
+    return tree.sql(dialect='postgres')
+
+def _execute_generated_sql(sql_query):
+    if isinstance(sql_query, dict) and "error" in sql_query:
+        return sql_query, None
+    
+    # Execute SQL query, capping unbounded SELECTs to one page
+    tree = _parse_select(sql_query)
+    if tree is not None:
+        return _run_select(_paginate(tree, st.session_state.get('page_size', 500)) or sql_query), sql_query
+    return execute_sql_query(sql_query), sql_query
+
+def _run_select(sql_query: str):
+    # Arrow IPC when the database exposes run_sql_arrow, the JSON RPC otherwise
+    if st.session_state.get('arrow_rpc'):
+        try:
+            df = _fetch_arrow(sql_query)
+            return df if len(df) else []
+        except Exception as e:
+            print(f"Arrow RPC call failed: {str(e)}, falling back to JSON results.")
+    # SELECTs never go through the table API, so skip parsing them again
+    return execute_sql_query(sql_query, table_api=False)
+
+def _to_dataframe(result):
+    import pandas as pd
+    
+    if isinstance(result, pd.DataFrame):
+        return result
+    if isinstance(result, list) and len(result) > 0 and isinstance(result[0], dict):
+        # Every row shares the first row's columns, so skip per-row key inference
+        df = pd.DataFrame.from_records(result, columns=list(result[0].keys()))
+        # dtype_backend needs pandas 2.0+
+        if _HAS_PYARROW and int(pd.__version__.split('.')[0]) >= 2:
+            import pyarrow as pa
+            
+            try:
+                df = df.convert_dtypes(dtype_backend='pyarrow')
+            except (OverflowError, TypeError, pa.ArrowInvalid) as e:
+                # e.g. integers beyond int64 from numeric columns or large SUMs keep object dtype
+                print(f"Arrow dtype conversion failed: {str(e)}, keeping object dtypes.")
+        return df
+    return None
+
+def _add_to_history(user_input: str, result, sql_query):
+    # The DataFrame is built once here and shared by the history and the latest results
+    item = {
+        "user_input": user_input,
+        "sql_query": sql_query,
+        "result": result,
+        "df": _to_dataframe(result)
+    }
+    if sql_query is not None:
+        # Numbered at append time so labels stay unique once old entries are dropped
+        st.session_state.query_count += 1
+        item["number"] = st.session_state.query_count
+        st.session_state.query_history.append(item)
+    return item
+
 def handle_database_query(user_input: str):
     if not st.session_state.connected:
-        return {"error": "Not connected to database"}
+        return _add_to_history(user_input, {"error": "Not connected to database"}, None)
         
     # Generate SQL from natural language
     sql_query = nl_to_sql_gemini(user_input)
+    result, sql_query = _execute_generated_sql(sql_query)
     
-    if isinstance(sql_query, dict) and "error" in sql_query:
-        return sql_query, None
+    # Add to history
+    return _add_to_history(user_input, result, sql_query)
+
+def handle_batch_queries(user_inputs: List[str]):
+    if not st.session_state.connected:
+        return [_add_to_history(user_input, {"error": "Not connected to database"}, None) for user_input in user_inputs]
+        
+    # Generate all SQL queries with one Gemini request
+    outputs = [_execute_generated_sql(sql_query) for sql_query in nl_to_sql_gemini_batch(user_inputs)]
     
-    # Execute SQL query
-    result = execute_sql_query(sql_query)
+    return [_add_to_history(user_input, result, sql_query) for user_input, (result, sql_query) in zip(user_inputs, outputs)]
+
+def handle_many(user_inputs: List[str], on_progress=None):
+    if not st.session_state.connected:
+        return [_add_to_history(user_input, {"error": "Not connected to database"}, None) for user_input in user_inputs]
     
-    # Add to history
-    st.session_state.query_history.append({
-        "user_input": user_input,
-        "sql_query": sql_query,
-        "result": result
-    })
+    # Worker threads need the script context to read session state and caches
+    ctx = get_script_run_ctx()
     
-    return result, sql_query
+    def process(user_input: str):
+        add_script_run_ctx(threading.current_thread(), ctx)
+        return _execute_generated_sql(nl_to_sql_gemini(user_input))
+    
+    futures = {_pool().submit(process, user_input): i for i, user_input in enumerate(user_inputs)}
+    outputs = [None] * len(user_inputs)
+    for done, future in enumerate(as_completed(futures), start=1):
+        outputs[futures[future]] = future.result()
+        if on_progress:
+            on_progress(done, len(user_inputs))
+    
+    # History is appended here, in question order, rather than from the workers
+    return [_add_to_history(user_input, result, sql_query) for user_input, (result, sql_query) in zip(user_inputs, outputs)]
 
-# Refresh schema button
-if st.sidebar.button("Refresh Database Schema") and st.session_state.connected:
-    with st.spinner("Fetching database schema..."):
-        st.session_state.schema_data = get_supabase_schema()
-        if "error" not in st.session_state.schema_data:
-            st.sidebar.success("Schema refreshed successfully!")
+def _render_result(result, df=None):
+    if df is None:
+        df = _to_dataframe(result)
+    if df is not None:
+        st.dataframe(df, use_container_width=True)
+    elif isinstance(result, dict):
+        if "error" in result:
+            st.error(result["error"])
+        elif "message" in result:
+            st.success(result["message"])
+            if "rows_affected" in result:
+                st.info(f"Rows affected: {result['rows_affected']}")
+        elif "warning" in result:
+            st.warning(result["warning"])
         else:
-            st.sidebar.error(f"Error fetching schema: {st.session_state.schema_data['error']}")
+            st.json(result)
+    elif isinstance(result, list) and len(result) == 0:
+        st.info("Query executed successfully, but returned no data.")
+    else:
+        st.write(result)
 
-# Display schema if available
-if st.session_state.connected and st.session_state.schema_data is None:
-    with st.spinner("Fetching database schema..."):
-        st.session_state.schema_data = get_supabase_schema()
+# Fragments rerun on their own instead of rerunning the whole script (Streamlit 1.33+)
+_fragment = getattr(st, "fragment", None) or getattr(st, "experimental_fragment", None) or (lambda func: func)
+_rerun = getattr(st, "rerun", None) or st.experimental_rerun
 
-# Schema expander
-if st.session_state.schema_data and "error" not in st.session_state.schema_data:
-    with st.sidebar.expander("Database Schema"):
-        for table, columns in st.session_state.schema_data.items():
-            st.sidebar.markdown(f"**{table}**")
-            st.sidebar.text(", ".join(columns))
+@st.cache_data(show_spinner=False)
+def _schema_markdown(schema: Dict[str, List[str]]) -> str:
+    return "\n\n".join(f"**{table}**  \n`{', '.join(columns)}`" for table, columns in schema.items())
 
-# User input
-if st.session_state.connected:
+@_fragment
+def _render_schema_sidebar(schema):
+    with st.expander("Database Schema"):
+        st.markdown(_schema_markdown(schema))
+
+@_fragment
+def _render_history(history, limit: int):
+    with st.expander("Query History", expanded=False):
+        for item in itertools.islice(reversed(history), limit):
+            st.markdown(f"### Query {item['number']}")
+            st.markdown(f"**Question:** {item['user_input']}")
+            st.markdown("**SQL Query:**")
+            st.code(item['sql_query'], language="sql")
+            
+            # Display results for this query
+            st.markdown("**Result:**")
+            if item.get('df') is not None:
+                st.dataframe(item['df'], use_container_width=True)
+            elif isinstance(item['result'], dict):
+                if "error" in item['result']:
+                    st.error(item['result']["error"])
+                elif "message" in item['result']:
+                    st.success(item['result']["message"])
+                else:
+                    st.json(item['result'])
+            else:
+                st.write(item['result'])
+                
+            st.markdown("---")
+
+@_fragment
+def _render_query_form():
     user_input = st.text_area("Ask a question about your database:", height=100, 
                               placeholder="Example: Show me all customers from New York", key="user_input")
     col1, col2 = st.columns([1, 5])
@@ -421,65 +827,133 @@ if st.session_state.connected:
         submit_button = st.button("Submit", type="primary", use_container_width=True)
     with col2:
         clear_button = st.button("Clear Results", use_container_width=True)
+    force_regenerate = st.checkbox("Force regenerate", help="Ignore previously generated SQL and ask Gemini again")
         
     # Process the query on button click
     if submit_button and user_input:
+        if force_regenerate:
+            _nl_to_sql_cached.clear()
         with st.spinner("Processing your request..."):
-            result, sql_query = handle_database_query(user_input)
-            
-            # Display results
-            st.subheader("Generated SQL:")
-            st.code(sql_query, language="sql")
-            
-            st.subheader("Result:")
-            if isinstance(result, list) and len(result) > 0 and isinstance(result[0], dict):
-                df = pd.DataFrame(result)
-                st.dataframe(df, use_container_width=True)
-            elif isinstance(result, dict):
-                if "error" in result:
-                    st.error(result["error"])
-                elif "message" in result:
-                    st.success(result["message"])
-                    if "rows_affected" in result:
-                        st.info(f"Rows affected: {result['rows_affected']}")
-                elif "warning" in result:
-                    st.warning(result["warning"])
-                else:
-                    st.json(result)
-            elif isinstance(result, list) and len(result) == 0:
-                st.info("Query executed successfully, but returned no data.")
-            else:
-                st.write(result)
+            item = handle_database_query(user_input)
+        _show_latest_results(False, [item])
+    
+    latest = st.session_state.latest_results
+    if latest and not latest["batch"]:
+        # Display results
+        item = latest["items"][0]
+        st.subheader("Generated SQL:")
+        st.code(item["sql_query"], language="sql")
+        
+        st.subheader("Result:")
+        _render_result(item["result"], item["df"])
+        _render_load_more(item, "load_more")
+    
+    # Batch questions, one per line
+    with st.expander("Batch questions", expanded=False):
+        batch_input = st.text_area("Ask several questions, one question per line:", height=150,
+                                   placeholder="Show me all customers from New York\nList the 5 most recent orders", key="batch_input")
+        combine_requests = st.checkbox("Combine into a single Gemini request", value=True, key="combine_requests")
+        batch_button = st.button("Submit Batch")
+        
+    if batch_button and batch_input:
+        questions = [line.strip() for line in batch_input.splitlines() if line.strip()]
+        if combine_requests:
+            with st.spinner(f"Processing {len(questions)} requests..."):
+                outputs = handle_batch_queries(questions)
+        else:
+            progress = st.progress(0.0, text=f"Processing {len(questions)} requests...")
+            outputs = handle_many(questions, lambda done, total: progress.progress(done / total, text=f"Processed {done} of {total} requests"))
+            progress.empty()
+        _show_latest_results(True, outputs)
+    
+    if latest and latest["batch"]:
+        for i, item in enumerate(latest["items"]):
+            st.markdown(f"**Question:** {item['user_input']}")
+            st.code(item["sql_query"], language="sql")
+            _render_result(item["result"], item["df"])
+            _render_load_more(item, f"load_more_{i}")
+            st.markdown("---")
     
     if clear_button:
-        st.session_state.query_history = []
-        st.experimental_rerun()
+        st.session_state.query_history = deque(maxlen=_HISTORY_LIMIT)
+        st.session_state.query_count = 0
+        st.session_state.latest_results = None
+        _rerun()
+
+def _next_offset(sql_query, result, offset: int = 0):
+    import pandas as pd
+    
+    # A full page from a paginated SELECT means there may be more rows to load
+    if not isinstance(sql_query, str) or not isinstance(result, (list, pd.DataFrame)) or len(result) < st.session_state.page_size:
+        return None
+    tree = _parse_select(sql_query)
+    # Without ORDER BY the row order is unspecified, so OFFSET pages could repeat or skip rows
+    if _paginate(tree, 1) is None or tree.args.get('order') is None:
+        return None
+    return offset + len(result)
+
+def _show_latest_results(batch: bool, items):
+    # Results are kept in session state and the whole app is rerun so the
+    # history expander outside this fragment picks up the new entries.
+    # Items are copied so Load more doesn't grow the history entry's DataFrame.
+    st.session_state.latest_results = {
+        "batch": batch,
+        "items": [dict(item, next_offset=_next_offset(item["sql_query"], item["result"])) for item in items],
+    }
+    _rerun()
+
+def _render_load_more(item, key: str):
+    if item.get("next_offset") is None or not st.button("Load more", key=key):
+        return
+    with st.spinner("Loading more rows..."):
+        more = _run_select(_paginate(_parse_select(item["sql_query"]), st.session_state.page_size, item["next_offset"]))
+    if isinstance(more, dict):
+        _render_result(more)
+        return
+    more_df = _to_dataframe(more)
+    if more_df is not None:
+        import pandas as pd
+        
+        item["df"] = pd.concat([item["df"], more_df], ignore_index=True)
+        item["result"] = item["df"]
+    item["next_offset"] = _next_offset(item["sql_query"], more, item["next_offset"])
+    _rerun()
+
+# Refresh schema button
+schema_data = None
+if st.sidebar.button("Refresh Database Schema") and st.session_state.connected:
+    with st.spinner("Fetching database schema..."):
+        _fetch_schema.clear()
+        st.session_state.schema_prompt = None
+        st.session_state.schema_key = None
+        schema_data = get_supabase_schema()
+        if "error" not in schema_data:
+            st.sidebar.success("Schema refreshed successfully!")
+        else:
+            st.sidebar.error(f"Error fetching schema: {schema_data['error']}")
+
+# Fetch schema if available (served from cache on reruns)
+if st.session_state.connected and schema_data is None:
+    with st.spinner("Fetching database schema..."):
+        schema_data = get_supabase_schema()
+
+# Pre-render the schema prompt once per schema load
+if schema_data and "error" not in schema_data and st.session_state.schema_prompt is None:
+    st.session_state.schema_prompt = format_schema_for_prompt(format_schema_lines(schema_data))
+    st.session_state.schema_key = hashlib.blake2b(st.session_state.schema_prompt.encode(), digest_size=8).hexdigest()
+
+# Schema expander
+if schema_data and "error" not in schema_data:
+    with st.sidebar:
+        _render_schema_sidebar(schema_data)
+
+# User input
+if st.session_state.connected:
+    _render_query_form()
         
     # Show query history
     if st.session_state.query_history:
-        with st.expander("Query History", expanded=False):
-            for i, item in enumerate(reversed(st.session_state.query_history)):
-                st.markdown(f"### Query {len(st.session_state.query_history) - i}")
-                st.markdown(f"**Question:** {item['user_input']}")
-                st.markdown("**SQL Query:**")
-                st.code(item['sql_query'], language="sql")
-                
-                # Display results for this query
-                st.markdown("**Result:**")
-                if isinstance(item['result'], list) and len(item['result']) > 0 and isinstance(item['result'][0], dict):
-                    df = pd.DataFrame(item['result'])
-                    st.dataframe(df, use_container_width=True)
-                elif isinstance(item['result'], dict):
-                    if "error" in item['result']:
-                        st.error(item['result']["error"])
-                    elif "message" in item['result']:
-                        st.success(item['result']["message"])
-                    else:
-                        st.json(item['result'])
-                else:
-                    st.write(item['result'])
-                    
-                st.markdown("---")
+        _render_history(st.session_state.query_history, st.session_state.history_size)
 else:
     st.info("Please connect to your database using the sidebar options.")
 